@@ -1,17 +1,22 @@
 import asyncio
 import logging
 import os
+import re
 from datetime import datetime, timedelta
-from typing import Any, Dict, Optional, Union
-import json
+from functools import partial
+from typing import Any, Optional, Union
+import sys
 
 from aiogram import Bot, Dispatcher, F, Router
 from aiogram.enums import ParseMode
-from aiogram.filters import Command, CommandStart
+from aiogram.filters import Command, CommandStart, StateFilter
 from aiogram.fsm.context import FSMContext
-from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseEventIsolation, BaseStorage, DefaultKeyBuilder
+from aiogram.fsm.storage.memory import MemoryStorage, SimpleEventIsolation
 from aiogram.types import (
     CallbackQuery,
+    InlineKeyboardMarkup,
     Message,
     ReplyKeyboardRemove,
     Contact,
@@ -20,11 +25,16 @@ from aiogram.types import (
     BotCommand,
 )
 from aiogram.client.default import DefaultBotProperties
+from cachetools import TTLCache
 from dotenv import load_dotenv
+import orjson
 from sqlalchemy import select
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import load_only
 
+from callbacks import DifficultyChoice, EventAction, PastEventsPage
 from database import (
+    EVENT_CARD_OPTIONS,
     Message as DBMessage,
     BroadcastMessage,
     User,
@@ -32,7 +42,7 @@ from database import (
     DatabaseMiddleware,
     get_users_by_language,
     init_db,
-    mark_message_sent_to_user,
+    mark_message_sent_to_users,
     save_broadcast_message,
     create_event,
     get_user_events,
@@ -44,8 +54,7 @@ from database import (
     update_payment_status,
     get_upcoming_events,
     get_past_events,
-    import_meetupshare_event,
-    get_or_create_user
+    import_meetupshare_event
 )
 from keyboards import (
     get_admin_chat_keyboard,
@@ -56,15 +65,22 @@ from keyboards import (
     get_phone_number_keyboard,
     get_main_keyboard,
     get_events_keyboard,
+    get_past_events_keyboard,
     get_event_actions_keyboard,
     get_event_type_keyboard,
     get_difficulty_keyboard,
     format_event_info
 )
-from payments import create_payment_intent, format_price
+from payments import create_payment_intent, format_price, verify_webhook_signature
 from scheduler import setup_scheduler
 from states import BroadcastStates, RegistrationStates, EventStates
 from texts import get_text, TEXTS
+from utils import gather_rate_limited, send_with_retry
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
 
 # Настраиваем логирование
 logging.basicConfig(
@@ -78,91 +94,91 @@ load_dotenv()
 # Конфигурация
 TOKEN = os.getenv("BOT_TOKEN")
 ADMIN_ID = int(os.getenv("ADMIN_ID", 0))
+REDIS_URL = os.getenv("REDIS_URL")
 
-logger.info(f"Token: {TOKEN}")
-logger.info(f"Admin ID: {ADMIN_ID}")
+# Сами значения в лог не пишем: токен даёт полный доступ к боту
+logger.info("Token loaded: %s", "***" if TOKEN else "MISSING")
+logger.info("Admin ID loaded: %s", "***" if ADMIN_ID else "MISSING")
 
 # Роутеры
 admin_router = Router(name="admin")
 user_router = Router(name="user")
+# Перехватывает любой текст, поэтому подключается последним и не заслоняет команды и шаги сценариев
+fallback_router = Router(name="fallback")
 
-# Словарь для хранения последней активности пользователей
-last_activity: Dict[int, datetime] = {}
+# Ключевые слова, по которым показываем справку о мероприятиях
+EVENTS_KEYWORDS_RE = re.compile("мероприятия|события|events", re.IGNORECASE)
 
-# Словарь для хранения данных рассылки
-broadcast_data: Dict[int, Dict[str, Any]] = {}
+# Строка с ID пользователя в сообщениях, которые бот пересылает админу
+TELEGRAM_ID_RE = re.compile(r"Telegram ID:\s*(\d+)")
 
-# Функции для работы с базой данных
-async def get_or_create_user(session: AsyncSession, telegram_user: Any) -> User:
-    try:
-        result = await session.execute(
-            select(User).where(User.telegram_id == telegram_user.id)
-        )
-        user = result.scalar_one_or_none()
-        
-        if user is None:
-            user = User(
-                telegram_id=telegram_user.id,
-                username=telegram_user.username,
-                first_name=telegram_user.first_name,
-                last_name=telegram_user.last_name,
-                registration_complete=False
-            )
-            session.add(user)
-            await session.commit()
-        
-        return user
-    except Exception as e:
-        await session.rollback()
-        logger.error(f"Error in get_or_create_user: {e}", exc_info=True)
-        raise
+# Пользователи, писавшие за последний час: им не повторяем подтверждение о получении сообщения.
+# Размер ограничен, записи истекают сами
+last_activity: TTLCache = TTLCache(maxsize=10_000, ttl=3600)
 
+# Функции для работы с базой данных
 async def save_message(session: AsyncSession, user: User, text: str, is_from_user: bool):
-    try:
-        message = DBMessage(
-            user_id=user.id,
-            text=text,
-            is_from_user=is_from_user
-        )
-        session.add(message)
-        await session.commit()
-    except Exception as e:
-        await session.rollback()
-        logger.error(f"Error in save_message: {e}", exc_info=True)
-        raise
+    # Коммит выполнит DatabaseMiddleware в конце обработки обновления
+    session.add(DBMessage(
+        user_id=user.id,
+        text=text,
+        is_from_user=is_from_user
+    ))
+
+async def notify_admin_new_user(bot: Bot, user: User, telegram_user: Any):
+    admin_message = (
+        f"New user registered:\n"
+        f"Name: {user.real_name}\n"
+        f"Phone: {user.phone_number}\n"
+        f"Country: {user.country or 'Not specified'}\n"
+        f"About: {user.about or 'Not specified'}\n"
+        f"Language: {user.language}\n"
+        f"Username: @{telegram_user.username or 'None'}\n"
+        f"Telegram ID: {telegram_user.id}"
+    )
+    await bot.send_message(
+        ADMIN_ID,
+        admin_message,
+        reply_markup=get_admin_chat_keyboard(telegram_user.id, telegram_user.username or "")
+    )
+
+EVENT_INFO_TEMPLATES = {
+    "en": (
+        "📅 {title}\n\n"
+        "📝 Description: {description}\n"
+        "📍 Location: {location}\n"
+        "🕒 Date and time: {date}\n"
+        "👥 Participants: {participants}{max_participants}\n"
+        "👤 Created by: {creator}"
+    ),
+    "ru": (
+        "📅 {title}\n\n"
+        "📝 Описание: {description}\n"
+        "📍 Место: {location}\n"
+        "🕒 Дата и время: {date}\n"
+        "👥 Участники: {participants}{max_participants}\n"
+        "👤 Создал: {creator}"
+    ),
+}
 
 def format_event_info(event: Event, lang: str = "en") -> str:
-    date_str = event.event_date.strftime("%d.%m.%Y %H:%M")
-    participants_count = len(event.participants)
-    max_participants_str = f"/{event.max_participants}" if event.max_participants else ""
-    
-    if lang == "en":
-        return (
-            f"📅 {event.title}\n\n"
-            f"📝 Description: {event.description}\n"
-            f"📍 Location: {event.location}\n"
-            f"🕒 Date and time: {date_str}\n"
-            f"👥 Participants: {participants_count}{max_participants_str}\n"
-            f"👤 Created by: {event.creator.real_name or event.creator.first_name}"
-        )
-    else:
-        return (
-            f"📅 {event.title}\n\n"
-            f"📝 Описание: {event.description}\n"
-            f"📍 Место: {event.location}\n"
-            f"🕒 Дата и время: {date_str}\n"
-            f"👥 Участники: {participants_count}{max_participants_str}\n"
-            f"👤 Создал: {event.creator.real_name or event.creator.first_name}"
-        )
+    # Как и раньше, любой язык, кроме английского, показываем по-русски
+    return EVENT_INFO_TEMPLATES.get(lang, EVENT_INFO_TEMPLATES["ru"]).format(
+        title=event.title,
+        description=event.description,
+        location=event.location,
+        date=event.event_date.strftime("%d.%m.%Y %H:%M"),
+        participants=len(event.participants),
+        max_participants=f"/{event.max_participants}" if event.max_participants else "",
+        creator=event.creator.real_name or event.creator.first_name
+    )
 
 # Хендлеры для регистрации
 @user_router.message(CommandStart())
-async def cmd_start(message: Message, state: FSMContext, **kwargs):
+async def cmd_start(message: Message, state: FSMContext, session: AsyncSession, user: User):
     try:
-        session = kwargs['session']
         try:
-            user = await get_or_create_user(session, message.from_user)
-            logger.info(f"New user started bot: {message.from_user.id} ({message.from_user.username})")
+            logger.info("New user started bot: %s (%s)", message.from_user.id, message.from_user.username)
             
             if not user.registration_complete:
                 # Сбрасываем состояние и начинаем регистрацию
@@ -175,29 +191,22 @@ async def cmd_start(message: Message, state: FSMContext, **kwargs):
             else:
                 # Для зарегистрированных пользователей показываем приветствие и инструкции
                 lang = user.language
-                main_keyboard = get_main_keyboard(lang)
                 await message.answer(
-                    TEXTS[lang]["welcome"],
-                    reply_markup=main_keyboard
-                )
-                await message.answer(
-                    TEXTS[lang]["help"],
-                    reply_markup=main_keyboard
+                    f"{TEXTS[lang]['welcome']}\n\n{TEXTS[lang]['help']}",
+                    reply_markup=get_main_keyboard(lang)
                 )
         except Exception as e:
             await session.rollback()
-            logger.error(f"Database error in start command: {e}", exc_info=True)
+            logger.error("Database error in start command: %s", e, exc_info=True)
             raise
     except Exception as e:
-        logger.error(f"Error in start command: {e}", exc_info=True)
+        logger.error("Error in start command: %s", e, exc_info=True)
         await message.answer("An error occurred. Please try again later.\n"
                            "Произошла ошибка. Пожалуйста, попробуйте позже.")
 
 @user_router.message(Command("help"))
-async def cmd_help(message: Message, **kwargs):
+async def cmd_help(message: Message, user: User):
     try:
-        session = kwargs['session']
-        user = await get_or_create_user(session, message.from_user)
         lang = user.language if user and user.registration_complete else "en"
         
         await message.answer(
@@ -205,21 +214,19 @@ async def cmd_help(message: Message, **kwargs):
             reply_markup=get_main_keyboard(lang) if user and user.registration_complete else None
         )
     except Exception as e:
-        logger.error(f"Error in help command: {e}", exc_info=True)
+        logger.error("Error in help command: %s", e, exc_info=True)
         await message.answer("An error occurred. Please try again later.\n"
                            "Произошла ошибка. Пожалуйста, попробуйте позже.")
 
 @user_router.message(lambda message: message.text and message.text.lower() in ['help', 'помощь'])
-async def text_help(message: Message, **kwargs):
-    await cmd_help(message, **kwargs)
+async def text_help(message: Message, user: User):
+    await cmd_help(message, user)
 
 @user_router.callback_query(F.data.startswith("lang_"))
-async def process_language_selection(callback: CallbackQuery, state: FSMContext, **kwargs):
+async def process_language_selection(callback: CallbackQuery, state: FSMContext, session: AsyncSession, user: User):
     try:
-        session = kwargs['session']
         try:
-            user = await get_or_create_user(session, callback.from_user)
-            language = callback.data.split("_")[1]
+            language = callback.data.partition("_")[2]
             
             await user.update_language(session, language)
             await callback.message.delete()
@@ -229,17 +236,15 @@ async def process_language_selection(callback: CallbackQuery, state: FSMContext,
             await state.update_data(language=language)
         except Exception as e:
             await session.rollback()
-            logger.error(f"Database error in language selection: {e}", exc_info=True)
+            logger.error("Database error in language selection: %s", e, exc_info=True)
             raise
     except Exception as e:
-        logger.error(f"Error processing language selection: {e}", exc_info=True)
+        logger.error("Error processing language selection: %s", e, exc_info=True)
         await callback.message.answer(get_text("error_occurred", "en"))
 
 @user_router.message(RegistrationStates.waiting_for_name)
-async def process_name(message: Message, state: FSMContext, **kwargs):
+async def process_name(message: Message, state: FSMContext, user: User):
     try:
-        session = kwargs['session']
-        user = await get_or_create_user(session, message.from_user)
         state_data = await state.get_data()
         language = state_data.get("language", "en")
         
@@ -248,7 +253,6 @@ async def process_name(message: Message, state: FSMContext, **kwargs):
             return
         
         user.real_name = message.text
-        await session.commit()
         
         await message.answer(
             get_text("phone_request", language),
@@ -257,14 +261,12 @@ async def process_name(message: Message, state: FSMContext, **kwargs):
         await state.set_state(RegistrationStates.waiting_for_phone)
         
     except Exception as e:
-        logger.error(f"Error processing name: {e}", exc_info=True)
+        logger.error("Error processing name: %s", e, exc_info=True)
         await message.answer(get_text("error_occurred", language))
 
 @user_router.message(RegistrationStates.waiting_for_phone)
-async def process_phone(message: Message, state: FSMContext, **kwargs):
+async def process_phone(message: Message, state: FSMContext, user: User):
     try:
-        session = kwargs['session']
-        user = await get_or_create_user(session, message.from_user)
         state_data = await state.get_data()
         language = state_data.get("language", "en")
         
@@ -276,7 +278,6 @@ async def process_phone(message: Message, state: FSMContext, **kwargs):
             return
         
         user.phone_number = message.contact.phone_number
-        await session.commit()
         
         await message.answer(
             get_text("country_request", language),
@@ -285,102 +286,63 @@ async def process_phone(message: Message, state: FSMContext, **kwargs):
         await state.set_state(RegistrationStates.waiting_for_country)
         
     except Exception as e:
-        logger.error(f"Error processing phone: {e}", exc_info=True)
+        logger.error("Error processing phone: %s", e, exc_info=True)
         await message.answer(get_text("error_occurred", language))
 
 @user_router.message(RegistrationStates.waiting_for_country)
-async def process_country(message: Message, state: FSMContext, **kwargs):
+async def process_country(message: Message, state: FSMContext, user: User):
     try:
-        session = kwargs['session']
-        user = await get_or_create_user(session, message.from_user)
         state_data = await state.get_data()
         language = state_data.get("language", "en")
         
         if message.text == "/skip":
             user.country = None
-            await session.commit()
-            await message.answer(get_text("skip_received", language))
-            await message.answer(get_text("about_request", language))
+            await message.answer(f"{get_text('skip_received', language)}\n\n{get_text('about_request', language)}")
             await state.set_state(RegistrationStates.waiting_for_about)
             return
         
         user.country = message.text
-        await session.commit()
         await message.answer(get_text("about_request", language))
         await state.set_state(RegistrationStates.waiting_for_about)
         
     except Exception as e:
-        logger.error(f"Error processing country: {e}", exc_info=True)
+        logger.error("Error processing country: %s", e, exc_info=True)
         await message.answer(get_text("error_occurred", language))
 
 @user_router.message(RegistrationStates.waiting_for_about)
-async def process_about(message: Message, state: FSMContext, **kwargs):
+async def process_about(message: Message, state: FSMContext, user: User):
     try:
-        session = kwargs['session']
-        user = await get_or_create_user(session, message.from_user)
         state_data = await state.get_data()
         language = state_data.get("language", "en")
         
         if message.text == "/skip":
             user.about = None
             user.registration_complete = True
-            await session.commit()
-            await message.answer(get_text("skip_received", language))
-            await message.answer(get_text("registration_complete", language))
+            await message.answer(f"{get_text('skip_received', language)}\n\n{get_text('registration_complete', language)}")
             await state.clear()
             
             # Уведомляем админа о новом пользователе
             if message.from_user.id != ADMIN_ID:
-                admin_message = (
-                    f"New user registered:\n"
-                    f"Name: {user.real_name}\n"
-                    f"Phone: {user.phone_number}\n"
-                    f"Country: {user.country or 'Not specified'}\n"
-                    f"About: {user.about or 'Not specified'}\n"
-                    f"Language: {user.language}\n"
-                    f"Username: @{message.from_user.username or 'None'}\n"
-                    f"Telegram ID: {message.from_user.id}"
-                )
-                await message.bot.send_message(
-                    ADMIN_ID,
-                    admin_message,
-                    reply_markup=get_admin_chat_keyboard(message.from_user.id, message.from_user.username or "")
-                )
+                await notify_admin_new_user(message.bot, user, message.from_user)
             return
         
         user.about = message.text
         user.registration_complete = True
-        await session.commit()
         await message.answer(get_text("registration_complete", language))
         await state.clear()
         
         # Уведомляем админа о новом пользователе
         if message.from_user.id != ADMIN_ID:
-            admin_message = (
-                f"New user registered:\n"
-                f"Name: {user.real_name}\n"
-                f"Phone: {user.phone_number}\n"
-                f"Country: {user.country or 'Not specified'}\n"
-                f"About: {user.about or 'Not specified'}\n"
-                f"Language: {user.language}\n"
-                f"Username: @{message.from_user.username or 'None'}\n"
-                f"Telegram ID: {message.from_user.id}"
-            )
-            await message.bot.send_message(
-                ADMIN_ID,
-                admin_message,
-                reply_markup=get_admin_chat_keyboard(message.from_user.id, message.from_user.username or "")
-            )
+            await notify_admin_new_user(message.bot, user, message.from_user)
         
     except Exception as e:
-        logger.error(f"Error processing about: {e}", exc_info=True)
+        logger.error("Error processing about: %s", e, exc_info=True)
         await message.answer(get_text("error_occurred", language))
 
-@user_router.message(Command("skip"))
-async def process_skip(message: Message, state: FSMContext, **kwargs):
+# Во время создания события /skip обрабатывают сами шаги сценария
+@user_router.message(Command("skip"), StateFilter(RegistrationStates.waiting_for_country, RegistrationStates.waiting_for_about))
+async def process_skip(message: Message, state: FSMContext, user: User):
     try:
-        session = kwargs['session']
-        user = await get_or_create_user(session, message.from_user)
         state_data = await state.get_data()
         language = state_data.get("language", "en")
         
@@ -388,53 +350,32 @@ async def process_skip(message: Message, state: FSMContext, **kwargs):
         
         if current_state == RegistrationStates.waiting_for_country:
             user.country = None
-            await session.commit()
-            await message.answer(get_text("skip_received", language))
-            await message.answer(get_text("about_request", language))
+            await message.answer(f"{get_text('skip_received', language)}\n\n{get_text('about_request', language)}")
             await state.set_state(RegistrationStates.waiting_for_about)
             
         elif current_state == RegistrationStates.waiting_for_about:
             user.about = None
             user.registration_complete = True
-            await session.commit()
-            await message.answer(get_text("skip_received", language))
-            await message.answer(get_text("registration_complete", language))
+            await message.answer(f"{get_text('skip_received', language)}\n\n{get_text('registration_complete', language)}")
             await state.clear()
             
             # Уведомляем админа о новом пользователе
             if message.from_user.id != ADMIN_ID:
-                admin_message = (
-                    f"New user registered:\n"
-                    f"Name: {user.real_name}\n"
-                    f"Phone: {user.phone_number}\n"
-                    f"Country: {user.country or 'Not specified'}\n"
-                    f"About: {user.about or 'Not specified'}\n"
-                    f"Language: {user.language}\n"
-                    f"Username: @{message.from_user.username or 'None'}\n"
-                    f"Telegram ID: {message.from_user.id}"
-                )
-                await message.bot.send_message(
-                    ADMIN_ID,
-                    admin_message,
-                    reply_markup=get_admin_chat_keyboard(message.from_user.id, message.from_user.username or "")
-                )
+                await notify_admin_new_user(message.bot, user, message.from_user)
         
     except Exception as e:
-        logger.error(f"Error processing skip command: {e}", exc_info=True)
+        logger.error("Error processing skip command: %s", e, exc_info=True)
         await message.answer(get_text("error_occurred", language))
 
 # Обработка текстовых сообщений
-@user_router.message(F.text)
-async def handle_user_message(message: Message, state: FSMContext, **kwargs):
+@fallback_router.message(F.text)
+async def handle_user_message(message: Message, state: FSMContext, session: AsyncSession, user: User):
     try:
-        session = kwargs['session']
-        user = await get_or_create_user(session, message.from_user)
-        
         # Логируем получение сообщения
-        logger.info(f"Received message from user {message.from_user.id} ({message.from_user.username}): {message.text[:20]}...")
+        logger.info("Received message from user %s (%s): %s...", message.from_user.id, message.from_user.username, message.text[:20])
         
         # Проверяем текст сообщения на ключевые слова о мероприятиях
-        if any(keyword in message.text.lower() for keyword in ["мероприятия", "события", "events"]):
+        if EVENTS_KEYWORDS_RE.search(message.text):
             response = (
                 "🎉 Добро пожаловать в систему управления мероприятиями!\n\n"
                 "У нас вы можете:\n"
@@ -459,7 +400,7 @@ async def handle_user_message(message: Message, state: FSMContext, **kwargs):
         if message.from_user.id == ADMIN_ID:
             current_state = await state.get_state()
             if current_state == BroadcastStates.waiting_for_message:
-                broadcast_data[ADMIN_ID] = {"message": message.text}
+                await state.update_data(broadcast_message=message.text)
                 await message.answer(
                     "Выберите целевую аудиторию для рассылки:",
                     reply_markup=get_broadcast_target_keyboard()
@@ -469,40 +410,34 @@ async def handle_user_message(message: Message, state: FSMContext, **kwargs):
             
             # Обычное сообщение от админа
             if message.reply_to_message:
-                logger.info(f"Admin is replying to message: {message.reply_to_message.message_id}")
+                logger.info("Admin is replying to message: %s", message.reply_to_message.message_id)
                 if message.reply_to_message.forward_from:
                     target_user_id = message.reply_to_message.forward_from.id
-                    logger.info(f"Got target user ID from forward_from: {target_user_id}")
+                    logger.info("Got target user ID from forward_from: %s", target_user_id)
                 else:
-                    try:
-                        original_message = message.reply_to_message.text or message.reply_to_message.caption or ""
-                        if "Telegram ID:" in original_message:
-                            user_info = original_message.split("Telegram ID: ")[1].split("\n")[0]
-                            target_user_id = int(user_info)
-                            logger.info(f"Got target user ID from message text: {target_user_id}")
-                        else:
-                            logger.warning("Could not find user ID in message")
-                            await message.answer("❌ Не удалось определить получателя сообщения")
-                            return
-                    except Exception as e:
-                        logger.error(f"Error extracting user ID: {e}")
+                    original_message = message.reply_to_message.text or message.reply_to_message.caption or ""
+                    match = TELEGRAM_ID_RE.search(original_message)
+                    if not match:
+                        logger.warning("Could not find user ID in message")
                         await message.answer("❌ Не удалось определить получателя сообщения")
                         return
+                    target_user_id = int(match.group(1))
+                    logger.info("Got target user ID from message text: %s", target_user_id)
 
                 try:
                     await save_message(session, user, message.text, False)
                     await message.bot.send_message(target_user_id, message.text)
                     await message.answer("✅ Сообщение отправлено")
-                    logger.info(f"Admin message sent to user {target_user_id}")
+                    logger.info("Admin message sent to user %s", target_user_id)
                 except Exception as e:
-                    logger.error(f"Error sending admin reply: {e}", exc_info=True)
+                    logger.error("Error sending admin reply: %s", e, exc_info=True)
                     await message.answer("❌ Ошибка при отправке сообщения")
             else:
                 logger.warning("Admin message is not a reply")
                 await message.answer("❌ Чтобы ответить пользователю, используйте ответ на его сообщение")
         else:
             # Сообщение от пользователя
-            logger.info(f"Processing message from user {message.from_user.id}")
+            logger.info("Processing message from user %s", message.from_user.id)
             try:
                 # Сохраняем сообщение в базу
                 await save_message(session, user, message.text, True)
@@ -523,27 +458,27 @@ async def handle_user_message(message: Message, state: FSMContext, **kwargs):
                     admin_message,
                     reply_markup=get_admin_chat_keyboard(message.from_user.id, message.from_user.username or "")
                 )
-                logger.info(f"Message forwarded to admin, message_id: {sent_message.message_id}")
+                logger.info("Message forwarded to admin, message_id: %s", sent_message.message_id)
                 
                 if message.from_user.id not in last_activity:
                     await message.answer(get_text("message_received", user.language))
                 
-                last_activity[message.from_user.id] = datetime.utcnow()
-                logger.info(f"Message from user {message.from_user.id} processed successfully")
+                last_activity[message.from_user.id] = True
+                logger.info("Message from user %s processed successfully", message.from_user.id)
             except Exception as e:
-                logger.error(f"Error handling user message: {e}", exc_info=True)
+                logger.error("Error handling user message: %s", e, exc_info=True)
                 await message.answer(get_text("error_occurred", user.language))
     except Exception as e:
-        logger.error(f"General error in message handler: {e}", exc_info=True)
+        logger.error("General error in message handler: %s", e, exc_info=True)
         await message.answer(get_text("error_occurred", user.language))
 
 # Хендлеры для админа
 @admin_router.message(Command("admin"))
-async def admin_panel(message: Message, **kwargs):
+async def admin_panel(message: Message):
     if message.from_user.id != ADMIN_ID:
         return
     
-    logger.info(f"Admin panel accessed by {message.from_user.id}")
+    logger.info("Admin panel accessed by %s", message.from_user.id)
     await message.answer(
         "Панель администратора",
         reply_markup=get_admin_main_keyboard()
@@ -559,19 +494,19 @@ async def create_broadcast(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
 
 @admin_router.callback_query(F.data.startswith("broadcast_"))
-async def process_broadcast(callback: CallbackQuery, state: FSMContext, **kwargs):
+async def process_broadcast(callback: CallbackQuery, state: FSMContext, session: AsyncSession):
     if callback.from_user.id != ADMIN_ID:
         return
     
-    action = callback.data.split("_")[1]
+    action = callback.data.partition("_")[2]
     
     if action == "cancel":
         await state.clear()
         await callback.message.edit_text("Рассылка отменена")
         return
     
-    session = kwargs['session']
-    broadcast_message = broadcast_data.get(ADMIN_ID, {}).get("message")
+    state_data = await state.get_data()
+    broadcast_message = state_data.get("broadcast_message")
     
     if not broadcast_message:
         await callback.message.edit_text("Ошибка: сообщение для рассылки не найдено")
@@ -579,44 +514,53 @@ async def process_broadcast(callback: CallbackQuery, state: FSMContext, **kwargs
         return
     
     target_language = None if action == "all" else action
-    users = await get_users_by_language(session, target_language)
+    recipients = await get_users_by_language(session, target_language)
     
-    if not users:
+    if not recipients:
         await callback.message.edit_text("Нет пользователей для рассылки")
         await state.clear()
         return
     
-    broadcast = await save_broadcast_message(session, broadcast_message, target_language)
-    
-    success_count = 0
-    for user in users:
+    async def send_one(user_id: int, telegram_id: int) -> Optional[int]:
         try:
-            await callback.bot.send_message(user.telegram_id, broadcast_message)
-            await mark_message_sent_to_user(session, broadcast.id, user.telegram_id)
-            success_count += 1
+            await send_with_retry(partial(callback.bot.send_message, telegram_id, broadcast_message))
+            return user_id
         except Exception as e:
-            logger.error(f"Error sending broadcast to user {user.telegram_id}: {e}")
-    
+            logger.error("Error sending broadcast to user %s: %s", telegram_id, e)
+            return None
+
+    # Отправляем параллельно в пределах лимита Telegram, а в базу пишем только после отправки:
+    # открытая на всю рассылку транзакция записи блокировала бы SQLite для остальных обновлений
+    results = await gather_rate_limited(partial(send_one, user_id, telegram_id) for user_id, telegram_id in recipients)
+    sent_ids = [user_id for user_id in results if user_id is not None]
+    broadcast = await save_broadcast_message(session, broadcast_message, target_language)
+    await mark_message_sent_to_users(session, broadcast.id, sent_ids)
+
     await callback.message.edit_text(
         f"Рассылка завершена\n"
-        f"Успешно отправлено: {success_count} из {len(users)}"
+        f"Успешно отправлено: {len(sent_ids)} из {len(recipients)}"
     )
     await state.clear()
-    broadcast_data.pop(ADMIN_ID, None)
 
 @admin_router.callback_query(F.data == "list_chats")
-async def list_chats(callback: CallbackQuery, **kwargs):
+async def list_chats(callback: CallbackQuery, session: AsyncSession):
     if callback.from_user.id != ADMIN_ID:
         return
     
-    session = kwargs['session']
     # Получаем пользователей с сообщениями за последние 24 часа
     yesterday = datetime.utcnow() - timedelta(days=1)
+    active_user_ids = select(DBMessage.user_id).where(DBMessage.created_at >= yesterday).distinct()
     result = await session.execute(
         select(User)
-        .join(DBMessage)
-        .where(DBMessage.created_at >= yesterday)
-        .distinct()
+        .options(load_only(
+            User.telegram_id,
+            User.username,
+            User.real_name,
+            User.phone_number,
+            User.country,
+            User.language
+        ))
+        .where(User.id.in_(active_user_ids))
     )
     users = result.scalars().all()
     
@@ -624,54 +568,60 @@ async def list_chats(callback: CallbackQuery, **kwargs):
         await callback.message.edit_text("Нет активных чатов")
         return
     
-    text = "Активные чаты:\n\n"
+    await callback.message.edit_text("Активные чаты:")
+    
+    # Все карточки уходят в чат администратора: отправляем по очереди, чтобы сохранить порядок
     for user in users:
         username = f"@{user.username}" if user.username else "Без username"
-        text += f"{user.real_name} ({username})\n"
-        text += f"Телефон: {user.phone_number}\n"
-        text += f"Страна: {user.country or 'Не указана'}\n"
-        text += f"Язык: {user.language}\n\n"
+        text = (
+            f"{user.real_name} ({username})\n"
+            f"Телефон: {user.phone_number}\n"
+            f"Страна: {user.country or 'Не указана'}\n"
+            f"Язык: {user.language}"
+        )
         keyboard = get_admin_chat_keyboard(user.telegram_id, user.username or "")
         await callback.message.answer(text, reply_markup=keyboard)
     
     await callback.answer()
 
 @admin_router.callback_query(F.data.startswith("history_"))
-async def show_chat_history(callback: CallbackQuery, **kwargs):
+async def show_chat_history(callback: CallbackQuery, session: AsyncSession):
     if callback.from_user.id != ADMIN_ID:
         return
     
-    session = kwargs['session']
-    user_id = int(callback.data.split("_")[1])
-    result = await session.execute(
+    user_id = int(callback.data.partition("_")[2])
+    messages = await session.stream_scalars(
         select(DBMessage)
         .join(User)
         .where(User.telegram_id == user_id)
         .order_by(DBMessage.created_at)
+        .execution_options(yield_per=500)
     )
-    messages = result.scalars().all()
-    
-    if not messages:
-        await callback.message.edit_text("История сообщений пуста")
-        return
     
+    # Читаем историю потоком и отправляем части по мере заполнения, не собирая весь текст в памяти.
+    # Части уходят по очереди: при параллельной отправке они могут прийти в чат не по порядку
+    max_length = 4096
     text = "История сообщений:\n\n"
-    for msg in messages:
+    has_messages = False
+    async for msg in messages:
+        has_messages = True
         sender = "Пользователь" if msg.is_from_user else "Админ"
         date = msg.created_at.strftime("%d.%m.%Y %H:%M")
         text += f"{date} - {sender}:\n{msg.text}\n\n"
+        while len(text) > max_length:
+            await callback.message.answer(text[:max_length])
+            text = text[max_length:]
     
-    # Разбиваем на части, если текст слишком длинный
-    max_length = 4096
-    for i in range(0, len(text), max_length):
-        chunk = text[i:i + max_length]
-        await callback.message.answer(chunk)
+    if not has_messages:
+        await callback.message.edit_text("История сообщений пуста")
+        return
     
+    await callback.message.answer(text)
     await callback.answer()
 
+@user_router.message(Command("events"))
 @user_router.message(F.text.in_(["📅 Events", "📅 События"]))
-async def show_events_menu(message: Message, session: AsyncSession):
-    user = await get_or_create_user(session, message.from_user)
+async def show_events_menu(message: Message, user: User):
     if not user.registration_complete:
         await message.answer(TEXTS[user.language]["user_not_registered"])
         return
@@ -681,9 +631,9 @@ async def show_events_menu(message: Message, session: AsyncSession):
         reply_markup=get_events_keyboard(user.language)
     )
 
+@user_router.message(Command("my", "my_events"))
 @user_router.message(F.text.in_(["🎯 My Events", "🎯 Мои события"]))
-async def show_my_events(message: Message, session: AsyncSession):
-    user = await get_or_create_user(session, message.from_user)
+async def show_my_events(message: Message, session: AsyncSession, user: User):
     if not user.registration_complete:
         await message.answer(TEXTS[user.language]["user_not_registered"])
         return
@@ -701,125 +651,127 @@ async def show_my_events(message: Message, session: AsyncSession):
             reply_markup=get_event_actions_keyboard(event.id, is_participant, is_creator, user.language)
         )
 
-@user_router.callback_query(F.data == "create_event")
-async def create_event_start(callback: CallbackQuery, state: FSMContext):
+async def advance_state(state: FSMContext, next_state: State, **data: Any):
+    """
+    Сохраняет ответ шага сценария и переходит к следующему шагу.
+    Пропущенные (None) значения не записываются: при чтении через get() отсутствующий ключ и так даёт None
+    """
+    data = {key: value for key, value in data.items() if value is not None}
+    if data:
+        await state.update_data(**data)
+    await state.set_state(next_state)
+
+@user_router.message(Command("create", "create_event"))
+async def start_event_creation(message: Message, state: FSMContext, user: User):
+    # Сбрасываем ответы прошлого незавершённого сценария, чтобы пропущенные шаги не унаследовали их.
+    # Язык сохраняем в состоянии: следующим шагам сценария не нужно обращаться к базе
+    await state.set_data({"language": user.language})
     await state.set_state(EventStates.waiting_for_type)
-    user = callback.from_user
-    session = callback.message.bot.get("session")
-    db_user = await get_or_create_user(session, user)
     
-    await callback.message.answer(
-        TEXTS[db_user.language]["event_create_type"],
+    await message.answer(
+        TEXTS[user.language]["event_create_type"],
         reply_markup=get_event_type_keyboard()
     )
+
+@user_router.callback_query(F.data == "create_event")
+async def create_event_start(callback: CallbackQuery, state: FSMContext, user: User):
+    await start_event_creation(callback.message, state, user)
     await callback.answer()
 
 @user_router.callback_query(F.data.startswith("event_type:"))
 async def process_event_type(callback: CallbackQuery, state: FSMContext):
-    event_type = callback.data.split(":")[1]
-    await state.update_data(event_type=event_type)
-    session = callback.message.bot.get("session")
-    user = await get_or_create_user(session, callback.from_user)
+    event_type = callback.data.partition(":")[2]
+    # Язык сохранён в состоянии при старте сценария: база на этом шаге не нужна
+    language = (await state.get_data()).get("language", "en")
     
-    await callback.message.answer(TEXTS[user.language]["event_create_theme"])
-    await state.set_state(EventStates.waiting_for_theme)
+    await callback.message.answer(get_text("event_create_theme", language))
+    await advance_state(state, EventStates.waiting_for_theme, event_type=event_type)
     await callback.answer()
 
 @user_router.message(EventStates.waiting_for_theme)
 async def process_event_theme(message: Message, state: FSMContext):
-    await state.update_data(theme=message.text)
-    session = message.bot.get("session")
-    user = await get_or_create_user(session, message.from_user)
-    
-    state_data = await state.get_data()
+    # update_data возвращает обновлённые данные: повторное чтение из хранилища не нужно
+    state_data = await state.update_data(theme=message.text)
     event_type = state_data.get("event_type")
+    language = state_data.get("language", "en")
     
     if event_type in ["quiz", "music_quiz"]:
         await message.answer(
-            TEXTS[user.language]["event_create_difficulty"],
+            get_text("event_create_difficulty", language),
             reply_markup=get_difficulty_keyboard()
         )
         await state.set_state(EventStates.waiting_for_difficulty)
     elif event_type in ["karaoke", "music_quiz"]:
-        await message.answer(TEXTS[user.language]["event_create_music_genre"])
+        await message.answer(get_text("event_create_music_genre", language))
         await state.set_state(EventStates.waiting_for_music_genre)
     else:
-        await message.answer(TEXTS[user.language]["event_create_title"])
+        await message.answer(get_text("event_create_title", language))
         await state.set_state(EventStates.waiting_for_title)
 
-@user_router.callback_query(F.data.startswith("difficulty:"))
-async def process_difficulty(callback: CallbackQuery, state: FSMContext):
-    difficulty = callback.data.split(":")[1]
-    await state.update_data(difficulty_level=difficulty)
-    session = callback.message.bot.get("session")
-    user = await get_or_create_user(session, callback.from_user)
+@user_router.callback_query(DifficultyChoice.filter())
+async def process_difficulty(callback: CallbackQuery, callback_data: DifficultyChoice, state: FSMContext):
+    state_data = await state.update_data(difficulty_level=callback_data.level)
+    language = state_data.get("language", "en")
     
-    state_data = await state.get_data()
     if state_data.get("event_type") == "music_quiz":
-        await callback.message.answer(TEXTS[user.language]["event_create_music_genre"])
+        await callback.message.answer(get_text("event_create_music_genre", language))
         await state.set_state(EventStates.waiting_for_music_genre)
     else:
-        await callback.message.answer(TEXTS[user.language]["event_create_max_teams"])
+        await callback.message.answer(get_text("event_create_max_teams", language))
         await state.set_state(EventStates.waiting_for_max_teams)
     await callback.answer()
 
 @user_router.message(EventStates.waiting_for_music_genre)
 async def process_music_genre(message: Message, state: FSMContext):
-    await state.update_data(music_genre=message.text)
-    session = message.bot.get("session")
-    user = await get_or_create_user(session, message.from_user)
+    state_data = await state.get_data()
+    language = state_data.get("language", "en")
     
-    await message.answer(TEXTS[user.language]["event_create_max_teams"])
-    await state.set_state(EventStates.waiting_for_max_teams)
+    await message.answer(get_text("event_create_max_teams", language))
+    await advance_state(state, EventStates.waiting_for_max_teams, music_genre=message.text)
 
 @user_router.message(EventStates.waiting_for_max_teams)
 async def process_max_teams(message: Message, state: FSMContext):
-    session = message.bot.get("session")
-    user = await get_or_create_user(session, message.from_user)
+    state_data = await state.get_data()
+    language = state_data.get("language", "en")
     
     if message.text == "/skip":
-        await state.update_data(max_teams=None)
-        await message.answer(TEXTS[user.language]["event_create_title"])
-        await state.set_state(EventStates.waiting_for_title)
+        await message.answer(get_text("event_create_title", language))
+        await advance_state(state, EventStates.waiting_for_title)
         return
     
     try:
         max_teams = int(message.text)
-        await state.update_data(max_teams=max_teams)
-        await message.answer(TEXTS[user.language]["event_create_team_size"])
-        await state.set_state(EventStates.waiting_for_team_size)
+        await message.answer(get_text("event_create_team_size", language))
+        await advance_state(state, EventStates.waiting_for_team_size, max_teams=max_teams)
     except ValueError:
-        await message.answer(TEXTS[user.language]["invalid_number"])
+        await message.answer(get_text("invalid_number", language))
 
 @user_router.message(EventStates.waiting_for_team_size)
 async def process_team_size(message: Message, state: FSMContext):
-    session = message.bot.get("session")
-    user = await get_or_create_user(session, message.from_user)
+    state_data = await state.get_data()
+    language = state_data.get("language", "en")
     
     if message.text == "/skip":
-        await state.update_data(team_size=None)
-        await message.answer(TEXTS[user.language]["event_create_title"])
-        await state.set_state(EventStates.waiting_for_title)
+        await message.answer(get_text("event_create_title", language))
+        await advance_state(state, EventStates.waiting_for_title)
         return
     
     try:
         team_size = int(message.text)
-        await state.update_data(team_size=team_size)
-        await message.answer(TEXTS[user.language]["event_create_title"])
-        await state.set_state(EventStates.waiting_for_title)
+        await message.answer(get_text("event_create_title", language))
+        await advance_state(state, EventStates.waiting_for_title, team_size=team_size)
     except ValueError:
-        await message.answer(TEXTS[user.language]["invalid_number"])
+        await message.answer(get_text("invalid_number", language))
 
-@user_router.callback_query(F.data == "available_events")
-async def show_available_events(callback: CallbackQuery, session: AsyncSession):
-    user = await get_or_create_user(session, callback.from_user)
+@user_router.message(Command("list", "available_events"))
+async def send_available_events(message: Message, session: AsyncSession, user: User):
     events = await get_upcoming_events(session)
     
     if not events:
-        await callback.message.answer(TEXTS[user.language]["no_events_available"])
-        await callback.answer()
+        await message.answer(TEXTS[user.language]["no_events_available"])
         return
     
+    # Карточки уходят в один чат по очереди: при параллельной отправке они пришли бы не по дате
     for event in events:
         is_participant = user in event.participants
         message_text = format_event_info(event, user.language)
@@ -832,18 +784,31 @@ async def show_available_events(callback: CallbackQuery, session: AsyncSession):
             else:
                 message_text += f"\n💰 Price: {price_text}"
         
-        await callback.message.answer(
+        await message.answer(
             message_text,
             reply_markup=get_event_actions_keyboard(event.id, is_participant, False, user.language)
         )
-    
+
+@user_router.callback_query(F.data == "available_events")
+async def show_available_events(callback: CallbackQuery, session: AsyncSession, user: User):
+    await send_available_events(callback.message, session, user)
     await callback.answer()
 
-@user_router.callback_query(F.data.startswith("join_event:"))
-async def join_event_callback(callback: CallbackQuery, session: AsyncSession, state: FSMContext):
-    event_id = int(callback.data.split(":")[1])
-    user = await get_or_create_user(session, callback.from_user)
-    event = await session.get(Event, event_id)
+async def update_event_card(message: Message, text: str, reply_markup: InlineKeyboardMarkup):
+    """
+    Обновляет карточку события. Если текст не изменился, отправляет только клавиатуру:
+    editMessageReplyMarkup не передаёт текст заново
+    """
+    if message.text == text:
+        await message.edit_reply_markup(reply_markup=reply_markup)
+    else:
+        await message.edit_text(text, reply_markup=reply_markup)
+
+@user_router.callback_query(EventAction.filter(F.action == "join"))
+async def join_event_callback(callback: CallbackQuery, callback_data: EventAction, session: AsyncSession, user: User):
+    event_id = callback_data.event_id
+    # Участники и создатель нужны и для join/leave, и для карточки: загружаем их вместе с событием
+    event = await session.get(Event, event_id, options=EVENT_CARD_OPTIONS)
     
     if not event:
         await callback.answer(TEXTS[user.language]["event_not_found"])
@@ -888,48 +853,50 @@ async def join_event_callback(callback: CallbackQuery, session: AsyncSession, st
             return
             
         except ValueError as e:
-            logger.error(f"Error creating payment: {e}")
+            logger.error("Error creating payment: %s", e)
             await callback.answer(TEXTS[user.language]["payment_error"])
             return
     
     # Если событие бесплатное или пользователь уже участник
     success = await join_event(session, event, user)
     if success:
-        await callback.message.edit_text(
+        await update_event_card(
+            callback.message,
             format_event_info(event, user.language),
-            reply_markup=get_event_actions_keyboard(event.id, True, False, user.language)
+            get_event_actions_keyboard(event.id, True, False, user.language)
         )
         await callback.answer(TEXTS[user.language]["event_joined"])
     else:
         await callback.answer(TEXTS[user.language]["event_full"])
 
-@user_router.callback_query(F.data.startswith("leave_event:"))
-async def leave_event_callback(callback: CallbackQuery, session: AsyncSession):
-    event_id = int(callback.data.split(":")[1])
-    user = await get_or_create_user(session, callback.from_user)
-    event = await session.get(Event, event_id)
+@user_router.callback_query(EventAction.filter(F.action == "leave"))
+async def leave_event_callback(callback: CallbackQuery, callback_data: EventAction, session: AsyncSession, user: User):
+    event_id = callback_data.event_id
+    # Участники и создатель нужны и для join/leave, и для карточки: загружаем их вместе с событием
+    event = await session.get(Event, event_id, options=EVENT_CARD_OPTIONS)
     
     if not event:
         await callback.answer(TEXTS[user.language]["event_not_found"])
         return
     
     await leave_event(session, event, user)
-    await callback.message.edit_text(
+    await update_event_card(
+        callback.message,
         format_event_info(event, user.language),
-        reply_markup=get_event_actions_keyboard(event.id, False, False, user.language)
+        get_event_actions_keyboard(event.id, False, False, user.language)
     )
     await callback.answer(TEXTS[user.language]["event_left"])
 
-@user_router.callback_query(F.data.startswith("cancel_event:"))
-async def cancel_event_callback(callback: CallbackQuery, session: AsyncSession):
-    event_id = int(callback.data.split(":")[1])
-    user = await get_or_create_user(session, callback.from_user)
-    event = await session.get(Event, event_id)
-    
-    if not event or event.creator_id != user.id:
+@user_router.callback_query(EventAction.filter(F.action == "cancel"))
+async def cancel_event_callback(callback: CallbackQuery, callback_data: EventAction, session: AsyncSession, user: User):
+    event_id = callback_data.event_id
+    # Права проверяем по одному столбцу, событие целиком загружаем только для создателя
+    creator_id = await session.scalar(select(Event.creator_id).where(Event.id == event_id))
+    if creator_id != user.id:
         await callback.answer(TEXTS[user.language]["event_not_found"])
         return
     
+    event = await session.get(Event, event_id, options=EVENT_CARD_OPTIONS)
     await cancel_event(session, event)
     await callback.message.edit_text(
         format_event_info(event, user.language) + "\n\n❌ " + TEXTS[user.language]["event_cancelled"]
@@ -937,8 +904,7 @@ async def cancel_event_callback(callback: CallbackQuery, session: AsyncSession):
     await callback.answer()
 
 @user_router.callback_query(F.data == "events_menu")
-async def return_to_events_menu(callback: CallbackQuery, session: AsyncSession):
-    user = await get_or_create_user(session, callback.from_user)
+async def return_to_events_menu(callback: CallbackQuery, user: User):
     await callback.message.edit_text(
         TEXTS[user.language]["events_menu"],
         reply_markup=get_events_keyboard(user.language)
@@ -956,13 +922,14 @@ async def stripe_webhook(message: Message, session: AsyncSession):
         if not message.web_app_data:
             return
         
-        payload = message.web_app_data.data
+        payload = message.web_app_data.data.encode()
         sig_header = message.web_app_data.button_text  # Используем button_text для передачи заголовка
         
-        if not verify_webhook_signature(payload.encode(), sig_header):
+        # Проверка подписи Stripe синхронная, выполняем её вне цикла событий
+        if not await asyncio.to_thread(verify_webhook_signature, payload, sig_header):
             return
         
-        event_json = json.loads(payload)
+        event_json = orjson.loads(payload)
         event_type = event_json["type"]
         
         if event_type == "payment_intent.succeeded":
@@ -972,21 +939,25 @@ async def stripe_webhook(message: Message, session: AsyncSession):
             # Обновляем статус платежа
             payment = await update_payment_status(session, payment_intent_id, "succeeded")
             if payment:
-                # Добавляем пользователя к участникам события
-                await join_event(session, payment.event, payment.user)
+                # Добавляем пользователя к участникам события. flush записывает строку сразу:
+                # об успехе сообщаем, только когда пользователь действительно добавлен
+                if not await join_event(session, payment.event, payment.user):
+                    logger.warning("Paid user %s was not added to full event %s", payment.user.telegram_id, payment.event.id)
+                    return
+                await session.flush()
                 
                 # Отправляем уведомление пользователю
                 success_message = TEXTS[payment.user.language]["payment_success"]
                 try:
                     await message.bot.send_message(payment.user.telegram_id, success_message)
                 except Exception as e:
-                    logger.error(f"Error sending payment success message: {e}")
+                    logger.error("Error sending payment success message: %s", e)
     except Exception as e:
-        logger.error(f"Error processing webhook: {e}")
+        logger.error("Error processing webhook: %s", e)
         return
 
-async def setup_bot_commands(bot: Bot):
-    commands_ru = [
+BOT_COMMANDS = {
+    "ru": [
         BotCommand(command="start", description="Запустить бота"),
         BotCommand(command="help", description="Показать справку"),
         BotCommand(command="events", description="Управление событиями"),
@@ -994,9 +965,8 @@ async def setup_bot_commands(bot: Bot):
         BotCommand(command="list", description="Показать список событий"),
         BotCommand(command="my", description="Мои события"),
         BotCommand(command="settings", description="Настройки"),
-    ]
-    
-    commands_en = [
+    ],
+    "en": [
         BotCommand(command="start", description="Start the bot"),
         BotCommand(command="help", description="Show help"),
         BotCommand(command="events", description="Event management"),
@@ -1004,17 +974,40 @@ async def setup_bot_commands(bot: Bot):
         BotCommand(command="list", description="Show events list"),
         BotCommand(command="my", description="My events"),
         BotCommand(command="settings", description="Settings"),
-    ]
-    
-    await bot.set_my_commands(commands_ru, language_code="ru")
-    await bot.set_my_commands(commands_en, language_code="en")
+    ],
+}
+
+async def setup_bot_commands(bot: Bot):
+    for language_code, commands in BOT_COMMANDS.items():
+        await bot.set_my_commands(commands, language_code=language_code)
     logger.info("Bot commands have been set up")
 
+SETTINGS_TEMPLATES = {
+    "en": (
+        (
+            "⚙️ Settings:\n\n"
+            "🌐 Language: {language}\n"
+            "📱 Phone: {phone}\n"
+            "🌍 Country: {country}\n"
+            "ℹ️ About: {about}"
+        ),
+        {"phone": "Not set", "country": "Not set", "about": "Not set"},
+    ),
+    "ru": (
+        (
+            "⚙️ Настройки:\n\n"
+            "🌐 Язык: {language}\n"
+            "📱 Телефон: {phone}\n"
+            "🌍 Страна: {country}\n"
+            "ℹ️ О себе: {about}"
+        ),
+        {"phone": "Не указан", "country": "Не указана", "about": "Не указано"},
+    ),
+}
+
 @user_router.message(Command("settings"))
-async def cmd_settings(message: Message, **kwargs):
+async def cmd_settings(message: Message, user: User):
     try:
-        session = kwargs['session']
-        user = await get_or_create_user(session, message.from_user)
         lang = user.language if user and user.registration_complete else "en"
         
         if not user or not user.registration_complete:
@@ -1024,38 +1017,23 @@ async def cmd_settings(message: Message, **kwargs):
             )
             return
         
-        settings_text = (
-            "⚙️ Settings:\n\n"
-            "🌐 Language: {}\n"
-            "📱 Phone: {}\n"
-            "🌍 Country: {}\n"
-            "ℹ️ About: {}"
-        ) if lang == "en" else (
-            "⚙️ Настройки:\n\n"
-            "🌐 Язык: {}\n"
-            "📱 Телефон: {}\n"
-            "🌍 Страна: {}\n"
-            "ℹ️ О себе: {}"
-        )
-        
+        template, not_set = SETTINGS_TEMPLATES.get(lang, SETTINGS_TEMPLATES["ru"])
         await message.answer(
-            settings_text.format(
-                "English" if user.language == "en" else "Русский",
-                user.phone_number or "Not set" if lang == "en" else "Не указан",
-                user.country or "Not set" if lang == "en" else "Не указана",
-                user.about or "Not set" if lang == "en" else "Не указано"
+            template.format(
+                language="English" if user.language == "en" else "Русский",
+                phone=user.phone_number or not_set["phone"],
+                country=user.country or not_set["country"],
+                about=user.about or not_set["about"]
             )
         )
     except Exception as e:
-        logger.error(f"Error in settings command: {e}", exc_info=True)
+        logger.error("Error in settings command: %s", e, exc_info=True)
         await message.answer("An error occurred. Please try again later.\n"
                            "Произошла ошибка. Пожалуйста, попробуйте позже.")
 
 @user_router.message(Command("cancel"))
-async def cmd_cancel(message: Message, state: FSMContext, **kwargs):
+async def cmd_cancel(message: Message, state: FSMContext, user: User):
     try:
-        session = kwargs['session']
-        user = await get_or_create_user(session, message.from_user)
         lang = user.language if user and user.registration_complete else "en"
         
         current_state = await state.get_state()
@@ -1073,66 +1051,41 @@ async def cmd_cancel(message: Message, state: FSMContext, **kwargs):
             reply_markup=get_main_keyboard(lang) if user and user.registration_complete else None
         )
     except Exception as e:
-        logger.error(f"Error in cancel command: {e}", exc_info=True)
+        logger.error("Error in cancel command: %s", e, exc_info=True)
         await message.answer("An error occurred. Please try again later.\n"
                            "Произошла ошибка. Пожалуйста, попробуйте позже.")
 
-# Добавляем алиасы для существующих команд
-@user_router.message(Command("events"))
-async def cmd_events(message: Message, session: AsyncSession):
-    await show_events_menu(message, session)
-
-@user_router.message(Command("my_events"))
-async def cmd_my_events(message: Message, session: AsyncSession):
-    await show_my_events(message, session)
-
-@user_router.message(Command("create_event"))
-async def cmd_create_event(message: Message, state: FSMContext):
-    callback = CallbackQuery(
-        id="1",
-        from_user=message.from_user,
-        chat_instance="1",
-        message=message,
-        data="create_event"
-    )
-    await create_event_start(callback, state)
-
-@user_router.message(Command("available_events"))
-async def cmd_available_events(message: Message, session: AsyncSession):
-    callback = CallbackQuery(
-        id="1",
-        from_user=message.from_user,
-        chat_instance="1",
-        message=message,
-        data="available_events"
-    )
-    await show_available_events(callback, session)
+# Карточки страницы собираются в одно сообщение, поэтому страница небольшая
+PAST_EVENTS_PAGE_SIZE = 5
 
-@user_router.callback_query(F.data == "past_events")
-async def show_past_events(callback: CallbackQuery, session: AsyncSession):
-    user = await get_or_create_user(session, callback.from_user)
-    past_events = await get_past_events(session)
+@user_router.callback_query(PastEventsPage.filter())
+async def show_past_events(callback: CallbackQuery, callback_data: PastEventsPage, session: AsyncSession, user: User):
+    # Запрашиваем на одно событие больше, чтобы узнать, есть ли следующая страница
+    past_events = await get_past_events(session, limit=PAST_EVENTS_PAGE_SIZE + 1, offset=callback_data.offset)
     
     if not past_events:
         text = "Нет прошедших событий" if user.language == "ru" else "No past events"
         await callback.answer(text, show_alert=True)
         return
     
+    next_offset = None
+    if len(past_events) > PAST_EVENTS_PAGE_SIZE:
+        past_events = past_events[:PAST_EVENTS_PAGE_SIZE]
+        next_offset = callback_data.offset + PAST_EVENTS_PAGE_SIZE
+    
     text = "📜 Прошедшие события:\n\n" if user.language == "ru" else "📜 Past Events:\n\n"
     for event in past_events:
         text += format_event_info(event, user.language) + "\n\n"
     
     await callback.message.edit_text(
         text,
-        reply_markup=get_events_keyboard(user.language)
+        reply_markup=get_past_events_keyboard(user.language, next_offset)
     )
+    await callback.answer()
 
 @admin_router.message(Command("import_meetupshare"))
-async def import_meetupshare(message: Message, session: AsyncSession):
+async def import_meetupshare(message: Message, session: AsyncSession, user: User):
     try:
-        # Получаем пользователя из базы данных
-        user = await get_or_create_user(session, message.from_user)
-        
         # Создаем тестовое событие Meetupshare
         event = await import_meetupshare_event(
             session=session,
@@ -1154,29 +1107,48 @@ async def import_meetupshare(message: Message, session: AsyncSession):
             f"✅ Событие успешно импортировано:\n\n{format_event_info(event)}"
         )
     except Exception as e:
-        logging.error(f"Error importing Meetupshare event: {e}")
+        logging.error("Error importing Meetupshare event: %s", e)
         await message.answer("❌ Ошибка при импорте события")
 
+def create_storage() -> BaseStorage:
+    """
+    Хранилище FSM: Redis, если задан REDIS_URL, иначе память процесса
+    """
+    if REDIS_URL:
+        from aiogram.fsm.storage.redis import RedisStorage
+        # id бота в ключах позволяет нескольким ботам делить один Redis
+        return RedisStorage.from_url(REDIS_URL, key_builder=DefaultKeyBuilder(with_bot_id=True))
+    return MemoryStorage()
+
+def create_events_isolation(storage: BaseStorage) -> BaseEventIsolation:
+    """
+    Изоляция событий: обновления одного чата обрабатываются по очереди.
+    Диспетчер берёт блокировку до чтения состояния FSM, поэтому следующее обновление видит
+    состояние, уже изменённое предыдущим. С Redis блокировка общая для всех экземпляров бота
+    """
+    if REDIS_URL:
+        return storage.create_isolation()
+    return SimpleEventIsolation()
+
 async def main():
     try:
-        # Загружаем переменные окружения
-        load_dotenv()
-        TOKEN = os.getenv("BOT_TOKEN")
-        ADMIN_ID = os.getenv("ADMIN_ID")
-        
-        logging.info(f"Token: {TOKEN}")
-        logging.info(f"Admin ID: {ADMIN_ID}")
         logging.info("Starting bot initialization...")
         
-        # Инициализируем бота с поддержкой HTML
-        bot = Bot(token=TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+        # Инициализируем бота с поддержкой HTML и без превью ссылок:
+        # Telegram не тратит время на загрузку превью в рассылках, напоминаниях и ссылках на оплату
+        bot = Bot(
+            token=TOKEN,
+            default=DefaultBotProperties(parse_mode=ParseMode.HTML, link_preview_is_disabled=True)
+        )
         
         # Создаем диспетчер
-        dp = Dispatcher(storage=MemoryStorage())
+        storage = create_storage()
+        dp = Dispatcher(storage=storage, events_isolation=create_events_isolation(storage))
         
         # Регистрируем роутеры
         dp.include_router(admin_router)
         dp.include_router(user_router)
+        dp.include_router(fallback_router)
         
         # Инициализируем базу данных
         await init_db()
@@ -1194,13 +1166,16 @@ async def main():
         # Запускаем бота
         await dp.start_polling(bot)
     except Exception as e:
-        logging.error(f"Error in main: {e}")
+        logging.error("Error in main: %s", e)
         raise
 
 if __name__ == "__main__":
+    # uvloop ускоряет цикл событий; на Windows он недоступен
+    if uvloop is not None and sys.platform != "win32":
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
     try:
         asyncio.run(main())
     except (KeyboardInterrupt, SystemExit):
         logger.info("Bot stopped")
     except Exception as e:
-        logger.error(f"Fatal error: {e}", exc_info=True) 
\ No newline at end of file
+        logger.error("Fatal error: %s", e, exc_info=True) 
\ No newline at end of file
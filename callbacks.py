@@ -0,0 +1,11 @@
+from aiogram.filters.callback_data import CallbackData
+
+class EventAction(CallbackData, prefix="event"):
+    action: str  # join, leave или cancel
+    event_id: int
+
+class DifficultyChoice(CallbackData, prefix="difficulty"):
+    level: str
+
+class PastEventsPage(CallbackData, prefix="past_events"):
+    offset: int
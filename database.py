@@ -1,13 +1,17 @@
+import logging
+import sqlite3
 from datetime import datetime, timedelta
-from typing import Any, Awaitable, Callable, Dict, Optional, List
+from typing import Any, Awaitable, Callable, Dict, Optional, List, Tuple
 
 from aiogram import BaseMiddleware
 from aiogram.types import TelegramObject
-from sqlalchemy import BigInteger, DateTime, ForeignKey, String, Boolean, Text, Enum, Table, Column, and_, select
+from sqlalchemy import BigInteger, DateTime, ForeignKey, Index, String, Boolean, Text, Enum, Table, Column, and_, delete, exists, func, insert, inspect, select, text, update
+from sqlalchemy import event as sa_event
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
-from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship, sessionmaker
+from sqlalchemy.orm import DeclarativeBase, Mapped, column_property, mapped_column, relationship, selectinload, sessionmaker, undefer
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 import enum
-import logging
 
 DATABASE_URL = "sqlite+aiosqlite:///feedback_bot.db"
 
@@ -22,6 +26,14 @@ event_participants = Table(
     Column('event_id', ForeignKey('events.id'), primary_key=True)
 )
 
+# Кому доставлена рассылка
+broadcast_recipients = Table(
+    'broadcast_recipients',
+    Base.metadata,
+    Column('broadcast_id', ForeignKey('broadcast_messages.id'), primary_key=True),
+    Column('user_id', ForeignKey('users.id'), primary_key=True)
+)
+
 class Language(enum.Enum):
     EN = "en"
     RU = "ru"
@@ -46,22 +58,23 @@ class User(Base):
     created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
     
     async def update_language(self, session: AsyncSession, language: str):
-        try:
-            self.language = language
-            await session.commit()
-        except Exception as e:
-            await session.rollback()
-            logging.error(f"Error updating language: {e}", exc_info=True)
-            raise
+        # Изменение сохранит транзакция DatabaseMiddleware при завершении обработки обновления
+        self.language = language
 
 class Event(Base):
     __tablename__ = "events"
+    __table_args__ = (
+        # Списки предстоящих и прошедших событий: равенство по is_active и диапазон с сортировкой по дате
+        Index("ix_events_active_date", "is_active", "event_date"),
+        # Выборка событий для напоминаний планировщиком
+        Index("ix_events_notify", "is_active", "notification_sent", "event_date"),
+    )
     
     id: Mapped[int] = mapped_column(primary_key=True)
     title: Mapped[str] = mapped_column(String(200))
     description: Mapped[str] = mapped_column(Text)
     location: Mapped[str] = mapped_column(String(200))
-    event_date: Mapped[datetime] = mapped_column(DateTime, index=True)
+    event_date: Mapped[datetime] = mapped_column(DateTime)
     max_participants: Mapped[Optional[int]] = mapped_column(BigInteger, nullable=True)
     price: Mapped[Optional[int]] = mapped_column(BigInteger, nullable=True)  # Цена в центах
     
@@ -78,11 +91,23 @@ class Event(Base):
     participants = relationship("User", secondary=event_participants, back_populates="participated_events")
     payments = relationship("Payment", back_populates="event")
     created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
-    is_active: Mapped[bool] = mapped_column(Boolean, default=True, index=True)
+    is_active: Mapped[bool] = mapped_column(Boolean, default=True)
     notification_sent: Mapped[bool] = mapped_column(Boolean, default=False)
+    # Число участников считается в SQL; по умолчанию не загружается, подключается через undefer
+    participant_count: Mapped[int] = column_property(
+        select(func.count(event_participants.c.user_id))
+        .where(event_participants.c.event_id == id)
+        .correlate_except(event_participants)
+        .scalar_subquery(),
+        deferred=True
+    )
 
 class Message(Base):
     __tablename__ = "messages"
+    __table_args__ = (
+        # История и список активных чатов выбирают сообщения по пользователю и времени
+        Index("ix_messages_user_time", "user_id", "created_at"),
+    )
     
     id: Mapped[int] = mapped_column(primary_key=True)
     user_id: Mapped[int] = mapped_column(ForeignKey("users.id"))
@@ -98,7 +123,6 @@ class BroadcastMessage(Base):
     text: Mapped[str] = mapped_column(Text)
     target_language: Mapped[Optional[str]] = mapped_column(String(2), nullable=True)
     sent_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
-    sent_to_users: Mapped[str] = mapped_column(Text, default="")  # Хранит список ID пользователей через запятую
 
 class Payment(Base):
     __tablename__ = "payments"
@@ -114,12 +138,86 @@ class Payment(Base):
     event = relationship("Event", back_populates="payments")
     created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
 
-engine = create_async_engine(DATABASE_URL, echo=True)
+# echo выключен: логирование каждого SQL-запроса заметно замедляет горячие пути.
+# timeout - сколько секунд SQLite ждёт снятия блокировки записи, прежде чем вернуть "database is locked"
+# Соединения (и их кэш страниц SQLite) переиспользуются через пул, pragma выполняются один раз на соединение.
+# pool_pre_ping и pool_recycle не нужны: локальный файл SQLite не разрывает простаивающие соединения
+engine = create_async_engine(
+    DATABASE_URL,
+    echo=False,
+    connect_args={"timeout": 30},
+    poolclass=AsyncAdaptedQueuePool,
+    pool_size=5,
+    max_overflow=10
+)
+
+@sa_event.listens_for(engine.sync_engine, "connect")
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    # WAL позволяет читать во время записи, synchronous=NORMAL в WAL убирает fsync на каждый коммит
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA cache_size=-64000")
+    cursor.close()
 async_session = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
 
+def drop_legacy_columns(connection):
+    """
+    Переносит данные из колонок, которых больше нет в моделях, и удаляет эти колонки из существующей базы
+    """
+    # sent_to_users заменена таблицей broadcast_recipients. В старых базах она NOT NULL,
+    # и без удаления сохранение новой рассылки падает с IntegrityError
+    columns = {column["name"] for column in inspect(connection).get_columns("broadcast_messages")}
+    if "sent_to_users" not in columns:
+        return
+
+    # История доставки хранилась как telegram_id через запятую: переносим её, сопоставляя с users.id
+    rows = connection.execute(
+        text("SELECT id, sent_to_users FROM broadcast_messages WHERE sent_to_users != ''")
+    ).all()
+    user_ids = dict(connection.execute(select(User.telegram_id, User.id)).all())
+    recipients = [
+        {"broadcast_id": broadcast_id, "user_id": user_ids[int(telegram_id)]}
+        for broadcast_id, sent_to_users in rows
+        for telegram_id in sent_to_users.split(",")
+        if telegram_id.strip().isdigit() and int(telegram_id) in user_ids
+    ]
+    for start in range(0, len(recipients), BROADCAST_RECIPIENTS_BATCH_SIZE):
+        connection.execute(
+            insert(broadcast_recipients)
+            .values(recipients[start:start + BROADCAST_RECIPIENTS_BATCH_SIZE])
+            .prefix_with("OR IGNORE")
+        )
+
+    # DROP COLUMN появился в SQLite 3.35: на более старой версии оставляем колонку, перенос повторится при запуске
+    if sqlite3.sqlite_version_info < (3, 35, 0):
+        logging.warning(
+            "SQLite %s does not support DROP COLUMN: drop broadcast_messages.sent_to_users manually",
+            sqlite3.sqlite_version
+        )
+        return
+    connection.execute(text("ALTER TABLE broadcast_messages DROP COLUMN sent_to_users"))
+
+# Одноколоночные индексы, которые перекрыты составными ix_events_active_date и ix_events_notify
+LEGACY_INDEXES = ("ix_events_event_date", "ix_events_is_active")
+
+def sync_indexes(connection):
+    """
+    Приводит индексы существующей базы к моделям
+    """
+    # create_all пропускает уже созданные таблицы вместе с их индексами: добавляем недостающие отдельно
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(connection, checkfirst=True)
+    for name in LEGACY_INDEXES:
+        connection.execute(text(f"DROP INDEX IF EXISTS {name}"))
+
 async def init_db():
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(drop_legacy_columns)
+        await conn.run_sync(sync_indexes)
 
 class DatabaseMiddleware(BaseMiddleware):
     async def __call__(
@@ -128,9 +226,20 @@ class DatabaseMiddleware(BaseMiddleware):
         event: TelegramObject,
         data: Dict[str, Any]
     ) -> Any:
+        # Хендлеру без session и user (например, шагам сценария, работающим только с FSM) база не нужна:
+        # не открываем ни соединение, ни транзакцию
+        handler_object = data.get("handler")
+        if handler_object is not None and not handler_object.varkw and not {"session", "user"} & handler_object.params:
+            return await handler(event, data)
+
         async with async_session() as session:
+            # Одна транзакция на обновление: коммит при успешном завершении хендлера, откат при исключении
             async with session.begin():
                 data["session"] = session
+                # Пользователь нужен почти каждому хендлеру: загружаем его один раз на обновление
+                telegram_user = data.get("event_from_user")
+                if telegram_user is not None:
+                    data["user"] = await get_or_create_user(session, telegram_user)
                 return await handler(event, data)
 
 # Функции для работы с рассылкой
@@ -140,25 +249,49 @@ async def save_broadcast_message(session: AsyncSession, text: str, target_langua
         target_language=target_language
     )
     session.add(broadcast)
-    await session.commit()
+    # flush, а не commit: id нужен сразу, а транзакцию завершит DatabaseMiddleware
+    await session.flush()
     return broadcast
 
-async def get_users_by_language(session: AsyncSession, language: Optional[str] = None):
-    query = select(User)
+async def get_users_by_language(session: AsyncSession, language: Optional[str] = None) -> List[Tuple[int, int]]:
+    """
+    Возвращает (id, telegram_id) получателей рассылки: остальные поля пользователя для отправки не нужны
+    """
+    query = select(User.id, User.telegram_id)
     if language:
         query = query.where(User.language == language)
     result = await session.execute(query)
-    return result.scalars().all()
+    return [tuple(row) for row in result.all()]
+
+# 500 строк по 2 параметра укладываются в лимит переменных SQLite на один запрос
+BROADCAST_RECIPIENTS_BATCH_SIZE = 500
+
+async def mark_message_sent_to_users(session: AsyncSession, broadcast_id: int, user_ids: List[int]):
+    """
+    Отмечает рассылку доставленной переданным пользователям (users.id)
+    """
+    # Одним INSERT ... VALUES (...), (...) на пачку строк вместо отдельной вставки на каждую
+    for start in range(0, len(user_ids), BROADCAST_RECIPIENTS_BATCH_SIZE):
+        batch = user_ids[start:start + BROADCAST_RECIPIENTS_BATCH_SIZE]
+        await session.execute(
+            insert(broadcast_recipients)
+            .values([{"broadcast_id": broadcast_id, "user_id": user_id} for user_id in batch])
+            .prefix_with("OR IGNORE")
+        )
 
-async def mark_message_sent_to_user(session: AsyncSession, broadcast_id: int, user_id: int):
-    broadcast = await session.get(BroadcastMessage, broadcast_id)
-    if broadcast:
-        sent_to = set(str(broadcast.sent_to_users).split(',')) if broadcast.sent_to_users else set()
-        sent_to.add(str(user_id))
-        broadcast.sent_to_users = ','.join(sent_to)
-        await session.commit()
+async def delete_messages_older_than(session: AsyncSession, days: int) -> int:
+    """
+    Удаляет сообщения старше указанного числа дней одним DELETE, возвращает число удалённых строк
+    """
+    cutoff = datetime.utcnow() - timedelta(days=days)
+    result = await session.execute(delete(Message).where(Message.created_at < cutoff))
+    return result.rowcount
 
 # Функции для работы с событиями
+
+# Связи, которые нужны для карточки события: подгружаем их пачкой, а не по запросу на каждое событие
+EVENT_CARD_OPTIONS = (selectinload(Event.creator), selectinload(Event.participants))
+
 async def create_event(
     session: AsyncSession,
     creator: User,
@@ -179,44 +312,47 @@ async def create_event(
         creator=creator
     )
     session.add(event)
-    await session.commit()
+    # flush, а не commit: id нужен сразу, а транзакцию завершит DatabaseMiddleware
+    await session.flush()
     return event
 
 async def get_user_events(session: AsyncSession, user: User, include_participated: bool = True) -> List[Event]:
-    query = select(Event).where(
-        (Event.creator_id == user.id) if not include_participated
-        else ((Event.creator_id == user.id) | (Event.id.in_([e.id for e in user.participated_events])))
-    ).where(Event.is_active == True)
+    condition = Event.creator_id == user.id
+    if include_participated:
+        # Участие проверяем в том же запросе через EXISTS, не загружая user.participated_events
+        condition = condition | exists().where(
+            event_participants.c.event_id == Event.id,
+            event_participants.c.user_id == user.id
+        )
+    query = select(Event).options(*EVENT_CARD_OPTIONS).where(condition).where(Event.is_active == True)
     result = await session.execute(query)
     return list(result.scalars().all())
 
 async def get_available_events(session: AsyncSession, exclude_user_id: Optional[int] = None) -> List[Event]:
-    query = select(Event).where(Event.is_active == True)
+    query = select(Event).options(*EVENT_CARD_OPTIONS).where(Event.is_active == True)
     if exclude_user_id:
         query = query.where(Event.creator_id != exclude_user_id)
     result = await session.execute(query)
     return list(result.scalars().all())
 
 async def join_event(session: AsyncSession, event: Event, user: User) -> bool:
+    # Вызывающий код загружает участников вместе с событием, поэтому считаем их без лишнего запроса
     if event.max_participants and len(event.participants) >= event.max_participants:
         return False
     if user not in event.participants:
         event.participants.append(user)
-        await session.commit()
     return True
 
 async def leave_event(session: AsyncSession, event: Event, user: User):
     if user in event.participants:
         event.participants.remove(user)
-        await session.commit()
 
 async def cancel_event(session: AsyncSession, event: Event):
     event.is_active = False
-    await session.commit()
 
 async def get_upcoming_events(session: AsyncSession) -> List[Event]:
     now = datetime.utcnow()
-    query = select(Event).where(
+    query = select(Event).options(*EVENT_CARD_OPTIONS).where(
         Event.event_date > now,
         Event.is_active == True
     ).order_by(Event.event_date)
@@ -226,7 +362,8 @@ async def get_upcoming_events(session: AsyncSession) -> List[Event]:
 async def get_events_for_notification(session: AsyncSession) -> List[Event]:
     now = datetime.utcnow()
     one_day_from_now = now + timedelta(days=1)
-    query = select(Event).where(
+    # Планировщик пишет создателю и всем участникам: загружаем их вместе с событиями
+    query = select(Event).options(*EVENT_CARD_OPTIONS).where(
         Event.event_date.between(now, one_day_from_now),
         Event.notification_sent == False,
         Event.is_active == True
@@ -234,9 +371,35 @@ async def get_events_for_notification(session: AsyncSession) -> List[Event]:
     result = await session.execute(query)
     return list(result.scalars().all())
 
-async def mark_notification_sent(session: AsyncSession, event: Event):
-    event.notification_sent = True
-    await session.commit()
+async def get_events_for_digest(session: AsyncSession) -> List[Event]:
+    now = datetime.utcnow()
+    next_week = now + timedelta(days=7)
+    # В дайджесте нужно только число участников: считаем его в SQL вместо загрузки списков
+    query = select(Event).options(undefer(Event.participant_count)).where(
+        Event.event_date.between(now, next_week),
+        Event.is_active == True
+    ).order_by(Event.event_date)
+    result = await session.execute(query)
+    return list(result.scalars().all())
+
+async def get_digest_recipients(session: AsyncSession) -> List[Tuple[int, str]]:
+    """
+    Возвращает (telegram_id, language) зарегистрированных пользователей
+    """
+    result = await session.execute(
+        select(User.telegram_id, User.language).where(User.registration_complete == True)
+    )
+    return [tuple(row) for row in result.all()]
+
+async def mark_notifications_sent(session: AsyncSession, event_ids: List[int]):
+    """
+    Отмечает уведомления отправленными одним UPDATE на всю пачку событий
+    """
+    if not event_ids:
+        return
+    await session.execute(
+        update(Event).where(Event.id.in_(event_ids)).values(notification_sent=True)
+    )
 
 async def create_payment(
     session: AsyncSession,
@@ -256,7 +419,7 @@ async def create_payment(
         event=event
     )
     session.add(payment)
-    await session.commit()
+    await session.flush()
     return payment
 
 async def update_payment_status(
@@ -264,29 +427,35 @@ async def update_payment_status(
     stripe_payment_id: str,
     status: str
 ) -> Optional[Payment]:
+    # Событие с участниками и пользователь нужны сразу после оплаты для join_event и уведомления
     result = await session.execute(
-        select(Payment).where(Payment.stripe_payment_id == stripe_payment_id)
+        select(Payment)
+        .options(selectinload(Payment.event).selectinload(Event.participants), selectinload(Payment.user))
+        .where(Payment.stripe_payment_id == stripe_payment_id)
     )
     payment = result.scalar_one_or_none()
     if payment:
         payment.status = status
-        await session.commit()
+        await session.flush()
     return payment
 
-async def get_past_events(session: AsyncSession) -> List[Event]:
+async def get_past_events(session: AsyncSession, limit: int = 20, offset: int = 0) -> List[Event]:
     # Получаем текущую дату
     current_date = datetime.utcnow()
     
     # Проверяем, есть ли события в базе
     events = await session.execute(
         select(Event)
+        .options(*EVENT_CARD_OPTIONS)
         .where(
             and_(
                 Event.event_date < current_date,
                 Event.is_active == True
             )
         )
-        .order_by(Event.event_date.desc())
+        .order_by(Event.event_date.desc(), Event.id.desc())
+        .limit(limit)
+        .offset(offset)
     )
     
     return list(events.scalars().all())
@@ -323,32 +492,33 @@ async def import_meetupshare_event(
         creator=creator
     )
     session.add(event)
-    await session.commit()
+    await session.flush()
     return event
 
 async def get_or_create_user(session: AsyncSession, telegram_user: Any) -> User:
     """
     Получает существующего пользователя или создает нового
     """
-    try:
-        result = await session.execute(
-            select(User).where(User.telegram_id == telegram_user.id)
-        )
-        user = result.scalar_one_or_none()
-        
-        if user is None:
-            user = User(
+    # telegram_id покрыт уникальным индексом: поиск стоит столько же, сколько выборка по первичному ключу
+    user = await session.scalar(select(User).where(User.telegram_id == telegram_user.id))
+    
+    if user is None:
+        # INSERT ... ON CONFLICT DO NOTHING RETURNING: новый пользователь создается одним запросом,
+        # а параллельное обновление от того же пользователя не приводит к ошибке уникальности
+        user = await session.scalar(
+            sqlite_insert(User)
+            .values(
                 telegram_id=telegram_user.id,
                 username=telegram_user.username,
                 first_name=telegram_user.first_name,
                 last_name=telegram_user.last_name,
                 registration_complete=False
             )
-            session.add(user)
-            await session.commit()
-        
-        return user
-    except Exception as e:
-        await session.rollback()
-        logging.error(f"Error in get_or_create_user: {e}", exc_info=True)
-        raise 
\ No newline at end of file
+            .on_conflict_do_nothing(index_elements=[User.telegram_id])
+            .returning(User)
+        )
+        if user is None:
+            # Строку успела вставить другая транзакция
+            user = await session.scalar(select(User).where(User.telegram_id == telegram_user.id))
+    
+    return user
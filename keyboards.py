@@ -1,8 +1,14 @@
+from functools import lru_cache
+from typing import Optional
+
 from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove
 from aiogram.utils.keyboard import InlineKeyboardBuilder
+from callbacks import DifficultyChoice, EventAction, PastEventsPage
 from texts import TEXTS
 from database import Event
 
+# Клавиатуры, зависящие только от языка, кэшируются: возвращаемые объекты общие, изменять их нельзя
+
 def get_admin_chat_keyboard(user_id: int, username: str) -> InlineKeyboardMarkup:
     builder = InlineKeyboardBuilder()
     builder.row(
@@ -19,6 +25,7 @@ def get_admin_chat_keyboard(user_id: int, username: str) -> InlineKeyboardMarkup
     )
     return builder.as_markup()
 
+@lru_cache(maxsize=8)
 def get_admin_main_keyboard() -> InlineKeyboardMarkup:
     builder = InlineKeyboardBuilder()
     builder.row(
@@ -35,6 +42,7 @@ def get_admin_main_keyboard() -> InlineKeyboardMarkup:
     )
     return builder.as_markup()
 
+@lru_cache(maxsize=8)
 def get_language_keyboard() -> InlineKeyboardMarkup:
     keyboard = InlineKeyboardMarkup(
         inline_keyboard=[
@@ -46,6 +54,7 @@ def get_language_keyboard() -> InlineKeyboardMarkup:
     )
     return keyboard
 
+@lru_cache(maxsize=8)
 def get_phone_number_keyboard(lang: str = "en") -> ReplyKeyboardMarkup:
     keyboard = ReplyKeyboardMarkup(
         keyboard=[
@@ -59,6 +68,7 @@ def get_phone_number_keyboard(lang: str = "en") -> ReplyKeyboardMarkup:
     )
     return keyboard
 
+@lru_cache(maxsize=8)
 def get_main_keyboard(lang: str = "en") -> ReplyKeyboardMarkup:
     keyboard = ReplyKeyboardMarkup(
         keyboard=[
@@ -71,6 +81,7 @@ def get_main_keyboard(lang: str = "en") -> ReplyKeyboardMarkup:
     )
     return keyboard
 
+@lru_cache(maxsize=8)
 def get_events_keyboard(lang: str = "en") -> InlineKeyboardMarkup:
     builder = InlineKeyboardBuilder()
     
@@ -89,7 +100,7 @@ def get_events_keyboard(lang: str = "en") -> InlineKeyboardMarkup:
         ))
         builder.row(InlineKeyboardButton(
             text="📜 Прошедшие события",
-            callback_data="past_events"
+            callback_data=PastEventsPage(offset=0).pack()
         ))
     else:
         builder.row(InlineKeyboardButton(
@@ -106,38 +117,50 @@ def get_events_keyboard(lang: str = "en") -> InlineKeyboardMarkup:
         ))
         builder.row(InlineKeyboardButton(
             text="📜 Past Events",
-            callback_data="past_events"
+            callback_data=PastEventsPage(offset=0).pack()
         ))
     
     return builder.as_markup()
 
-def get_event_actions_keyboard(event_id: int, is_participant: bool, is_creator: bool, lang: str = "en") -> InlineKeyboardMarkup:
+def get_past_events_keyboard(lang: str = "en", next_offset: Optional[int] = None) -> InlineKeyboardMarkup:
+    # Меню событий берём из кэша и только добавляем перед ним кнопку следующей страницы
+    rows = list(get_events_keyboard(lang).inline_keyboard)
+    if next_offset is not None:
+        rows.insert(0, [InlineKeyboardButton(
+            text="➡️ Next page" if lang == "en" else "➡️ Следующая страница",
+            callback_data=PastEventsPage(offset=next_offset).pack()
+        )])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+@lru_cache(maxsize=8)
+def get_event_actions_template(is_participant: bool, is_creator: bool, lang: str = "en") -> tuple:
+    """Подписи кнопок и действия EventAction; от события зависит только его id"""
     buttons = []
     
     if not is_creator and not is_participant:
-        buttons.append([InlineKeyboardButton(
-            text="✅ Join" if lang == "en" else "✅ Присоединиться",
-            callback_data=f"join_event:{event_id}"
-        )])
+        buttons.append(("✅ Join" if lang == "en" else "✅ Присоединиться", "join"))
     elif not is_creator and is_participant:
-        buttons.append([InlineKeyboardButton(
-            text="❌ Leave" if lang == "en" else "❌ Покинуть",
-            callback_data=f"leave_event:{event_id}"
-        )])
+        buttons.append(("❌ Leave" if lang == "en" else "❌ Покинуть", "leave"))
     
     if is_creator:
-        buttons.append([InlineKeyboardButton(
-            text="🚫 Cancel Event" if lang == "en" else "🚫 Отменить событие",
-            callback_data=f"cancel_event:{event_id}"
-        )])
+        buttons.append(("🚫 Cancel Event" if lang == "en" else "🚫 Отменить событие", "cancel"))
     
+    return tuple(buttons)
+
+# Одни и те же карточки событий показываются многим пользователям: кэшируем и готовую разметку
+@lru_cache(maxsize=1024)
+def get_event_actions_keyboard(event_id: int, is_participant: bool, is_creator: bool, lang: str = "en") -> InlineKeyboardMarkup:
+    buttons = [
+        [InlineKeyboardButton(text=text, callback_data=EventAction(action=action, event_id=event_id).pack())]
+        for text, action in get_event_actions_template(is_participant, is_creator, lang)
+    ]
     buttons.append([InlineKeyboardButton(
         text="◀️ Back" if lang == "en" else "◀️ Назад",
         callback_data="events_menu"
     )])
-    
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
+@lru_cache(maxsize=8)
 def get_broadcast_confirmation_keyboard(lang: str = "en") -> InlineKeyboardMarkup:
     keyboard = InlineKeyboardMarkup(
         inline_keyboard=[
@@ -153,6 +176,7 @@ def get_broadcast_confirmation_keyboard(lang: str = "en") -> InlineKeyboardMarku
     )
     return keyboard
 
+@lru_cache(maxsize=8)
 def get_broadcast_target_keyboard() -> InlineKeyboardMarkup:
     builder = InlineKeyboardBuilder()
     builder.row(
@@ -167,6 +191,7 @@ def get_broadcast_target_keyboard() -> InlineKeyboardMarkup:
     )
     return builder.as_markup()
 
+@lru_cache(maxsize=8)
 def get_broadcast_confirm_keyboard() -> InlineKeyboardMarkup:
     builder = InlineKeyboardBuilder()
     builder.row(
@@ -175,6 +200,7 @@ def get_broadcast_confirm_keyboard() -> InlineKeyboardMarkup:
     )
     return builder.as_markup()
 
+@lru_cache(maxsize=8)
 def get_event_type_keyboard() -> InlineKeyboardMarkup:
     """Клавиатура для выбора типа мероприятия"""
     keyboard = [
@@ -189,13 +215,14 @@ def get_event_type_keyboard() -> InlineKeyboardMarkup:
     ]
     return InlineKeyboardMarkup(inline_keyboard=keyboard)
 
+@lru_cache(maxsize=8)
 def get_difficulty_keyboard() -> InlineKeyboardMarkup:
     """Клавиатура для выбора уровня сложности"""
     keyboard = [
         [
-            InlineKeyboardButton(text="😊 Easy", callback_data="difficulty:easy"),
-            InlineKeyboardButton(text="🤔 Medium", callback_data="difficulty:medium"),
-            InlineKeyboardButton(text="🧠 Hard", callback_data="difficulty:hard")
+            InlineKeyboardButton(text="😊 Easy", callback_data=DifficultyChoice(level="easy").pack()),
+            InlineKeyboardButton(text="🤔 Medium", callback_data=DifficultyChoice(level="medium").pack()),
+            InlineKeyboardButton(text="🧠 Hard", callback_data=DifficultyChoice(level="hard").pack())
         ]
     ]
     return InlineKeyboardMarkup(inline_keyboard=keyboard)
@@ -1,7 +1,9 @@
+import asyncio
 import os
 from typing import Optional, Tuple
 
 import stripe
+from cachetools import LRUCache
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -10,6 +12,10 @@ stripe.api_key = os.getenv("STRIPE_SECRET_KEY")
 STRIPE_PUBLIC_KEY = os.getenv("STRIPE_PUBLIC_KEY")
 WEBHOOK_SECRET = os.getenv("STRIPE_WEBHOOK_SECRET")
 
+# Конечные статусы платежа больше не меняются, поэтому их можно не запрашивать у Stripe повторно
+TERMINAL_PAYMENT_STATUSES = frozenset({"succeeded", "canceled"})
+_terminal_status_cache: LRUCache = LRUCache(maxsize=4096)
+
 async def create_payment_intent(
     amount: int,
     currency: str = "usd",
@@ -23,7 +29,9 @@ async def create_payment_intent(
     :return: (payment_intent_id, client_secret)
     """
     try:
-        intent = stripe.PaymentIntent.create(
+        # SDK Stripe синхронный: HTTP-запрос выполняем в потоке, чтобы не блокировать цикл событий
+        intent = await asyncio.to_thread(
+            stripe.PaymentIntent.create,
             amount=amount,
             currency=currency,
             metadata=metadata or {},
@@ -45,16 +53,28 @@ def verify_webhook_signature(payload: bytes, sig_header: str) -> bool:
     except Exception:
         return False
 
-def get_payment_status(payment_intent_id: str) -> str:
+async def get_payment_status(payment_intent_id: str) -> str:
     """
     Получает статус платежа
     """
+    cached_status = _terminal_status_cache.get(payment_intent_id)
+    if cached_status is not None:
+        return cached_status
     try:
-        intent = stripe.PaymentIntent.retrieve(payment_intent_id)
+        intent = await asyncio.to_thread(stripe.PaymentIntent.retrieve, payment_intent_id)
+        if intent.status in TERMINAL_PAYMENT_STATUSES:
+            _terminal_status_cache[payment_intent_id] = intent.status
         return intent.status
     except stripe.error.StripeError as e:
         raise ValueError(f"Error retrieving payment status: {str(e)}")
 
+# Шаблоны отображения цены для известных валют
+CURRENCY_FORMATS = {
+    "usd": "${:.2f}",
+    "eur": "€{:.2f}",
+    "rub": "{:.0f}₽",
+}
+
 def format_price(amount: int, currency: str = "usd") -> str:
     """
     Форматирует цену для отображения
@@ -62,10 +82,7 @@ def format_price(amount: int, currency: str = "usd") -> str:
     :param currency: валюта
     :return: отформатированная строка с ценой
     """
-    if currency.lower() == "usd":
-        return f"${amount/100:.2f}"
-    elif currency.lower() == "eur":
-        return f"€{amount/100:.2f}"
-    elif currency.lower() == "rub":
-        return f"{amount/100:.0f}₽"
+    price_format = CURRENCY_FORMATS.get(currency.lower())
+    if price_format is not None:
+        return price_format.format(amount / 100)
     return f"{amount/100:.2f} {currency.upper()}" 
\ No newline at end of file
@@ -1,20 +1,43 @@
-from datetime import datetime, timedelta
-from typing import Optional
+import logging
+from functools import partial
+from typing import List, Optional
 
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
 from aiogram import Bot
 
-from database import async_session, get_events_for_notification, mark_notification_sent
+from database import (
+    Event,
+    async_session,
+    delete_messages_older_than,
+    get_digest_recipients,
+    get_events_for_digest,
+    get_events_for_notification,
+    mark_notifications_sent
+)
+from utils import gather_rate_limited, send_with_retry
+
+logger = logging.getLogger(__name__)
 
 scheduler = AsyncIOScheduler()
 
+async def send_safely(bot: Bot, chat_id: int, text: str, error_message: str):
+    """
+    Отправляет сообщение, повторяя его после ожидания 429; ошибка одной отправки не прерывает остальные
+    """
+    try:
+        await send_with_retry(partial(bot.send_message, chat_id, text))
+    except Exception as e:
+        logger.error("%s: %s", error_message, e)
+
 async def send_event_notifications(bot: Bot):
     """
     Отправляет уведомления о предстоящих событиях
     """
-    async with async_session() as session:
+    # Вне DatabaseMiddleware транзакцию открываем сами: она фиксируется одним коммитом в конце задачи
+    async with async_session() as session, session.begin():
         events = await get_events_for_notification(session)
+        sends = []
         for event in events:
             # Отправляем уведомление создателю события
             creator_message = (
@@ -23,10 +46,7 @@ async def send_event_notifications(bot: Bot):
                 f"Место: {event.location}\n"
                 f"Участники: {len(event.participants)}"
             )
-            try:
-                await bot.send_message(event.creator.telegram_id, creator_message)
-            except Exception as e:
-                print(f"Error sending notification to creator: {e}")
+            sends.append(partial(send_safely, bot, event.creator.telegram_id, creator_message, "Error sending notification to creator"))
 
             # Отправляем уведомления участникам
             participant_message = (
@@ -34,72 +54,87 @@ async def send_event_notifications(bot: Bot):
                 f"Событие '{event.title}' начнется через 24 часа.\n"
                 f"Место: {event.location}"
             )
-            for participant in event.participants:
-                try:
-                    await bot.send_message(participant.telegram_id, participant_message)
-                except Exception as e:
-                    print(f"Error sending notification to participant: {e}")
+            sends.extend(
+                partial(send_safely, bot, participant.telegram_id, participant_message, "Error sending notification to participant")
+                for participant in event.participants
+            )
+
+        # Все уведомления уходят конкурентно, но не чаще лимита Telegram
+        await gather_rate_limited(sends)
+
+        # Отмечаем, что уведомления отправлены
+        await mark_notifications_sent(session, [event.id for event in events])
+
+def build_digest(events: List[Event], language: str) -> str:
+    """
+    Формирует текст дайджеста на указанном языке
+    """
+    # Части собираются в список и склеиваются один раз: += копировал бы всё сообщение на каждом шаге
+    if language == "ru":
+        parts = ["📅 Предстоящие события на следующую неделю:\n\n"]
+    else:
+        parts = ["📅 Upcoming events for the next week:\n\n"]
+
+    for event in events:
+        event_date = event.event_date.strftime("%d.%m.%Y %H:%M")
+        if language == "ru":
+            parts.append(
+                f"🎯 {event.title}\n"
+                f"📍 Место: {event.location}\n"
+                f"🕒 Дата: {event_date}\n"
+                f"👥 Участники: {event.participant_count}"
+            )
+        else:
+            parts.append(
+                f"🎯 {event.title}\n"
+                f"📍 Location: {event.location}\n"
+                f"🕒 Date: {event_date}\n"
+                f"👥 Participants: {event.participant_count}"
+            )
+        
+        if event.price:
+            if language == "ru":
+                parts.append(f"\n💰 Цена: {event.price/100:.2f} руб.")
+            else:
+                parts.append(f"\n💰 Price: ${event.price/100:.2f}")
+        
+        parts.append("\n\n")
 
-            # Отмечаем, что уведомления отправлены
-            await mark_notification_sent(session, event)
+    return "".join(parts)
 
 async def send_events_digest(bot: Bot):
     """
     Отправляет еженедельный дайджест событий
     """
     async with async_session() as session:
-        # Получаем всех пользователей с их языковыми настройками
-        result = await session.execute("SELECT DISTINCT telegram_id, language FROM users WHERE registration_complete = true")
-        users = result.fetchall()
-
         # Получаем предстоящие события
-        now = datetime.utcnow()
-        next_week = now + timedelta(days=7)
-        result = await session.execute(
-            "SELECT * FROM events WHERE event_date BETWEEN :start AND :end AND is_active = true ORDER BY event_date",
-            {"start": now, "end": next_week}
-        )
-        events = result.fetchall()
-
+        events = await get_events_for_digest(session)
         if not events:
             return
 
-        for user_id, language in users:
-            # Формируем сообщение на нужном языке
-            if language == "ru":
-                message = "📅 Предстоящие события на следующую неделю:\n\n"
-            else:
-                message = "📅 Upcoming events for the next week:\n\n"
-
-            for event in events:
-                event_date = event.event_date.strftime("%d.%m.%Y %H:%M")
-                if language == "ru":
-                    message += (
-                        f"🎯 {event.title}\n"
-                        f"📍 Место: {event.location}\n"
-                        f"🕒 Дата: {event_date}\n"
-                        f"👥 Участники: {len(event.participants)}"
-                    )
-                else:
-                    message += (
-                        f"🎯 {event.title}\n"
-                        f"📍 Location: {event.location}\n"
-                        f"🕒 Date: {event_date}\n"
-                        f"👥 Participants: {len(event.participants)}"
-                    )
-                
-                if event.price:
-                    if language == "ru":
-                        message += f"\n💰 Цена: {event.price/100:.2f} руб."
-                    else:
-                        message += f"\n💰 Price: ${event.price/100:.2f}"
-                
-                message += "\n\n"
-
-            try:
-                await bot.send_message(user_id, message)
-            except Exception as e:
-                print(f"Error sending digest to user {user_id}: {e}")
+        # Получаем всех пользователей с их языковыми настройками
+        users = await get_digest_recipients(session)
+
+    # Текст одинаков для всех пользователей с одним языком: формируем его один раз
+    digest_ru = build_digest(events, "ru")
+    digest_en = build_digest(events, "en")
+
+    sends = [
+        partial(send_safely, bot, user_id, digest_ru if language == "ru" else digest_en, f"Error sending digest to user {user_id}")
+        for user_id, language in users
+    ]
+    await gather_rate_limited(sends)
+
+# Сколько дней хранится переписка пользователей с администратором
+MESSAGE_RETENTION_DAYS = 90
+
+async def prune_old_messages():
+    """
+    Удаляет старые сообщения, чтобы таблица и её индекс не росли бесконечно
+    """
+    async with async_session() as session, session.begin():
+        deleted = await delete_messages_older_than(session, MESSAGE_RETENTION_DAYS)
+        logger.info("Pruned %s old messages", deleted)
 
 def setup_scheduler(bot: Bot):
     """
@@ -123,4 +158,12 @@ def setup_scheduler(bot: Bot):
         replace_existing=True
     )
 
+    # Чистим старые сообщения каждую ночь в 03:00
+    scheduler.add_job(
+        prune_old_messages,
+        trigger=CronTrigger(hour=3),
+        id='prune_old_messages',
+        replace_existing=True
+    )
+
     scheduler.start() 
\ No newline at end of file
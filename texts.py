@@ -41,6 +41,7 @@ TEXTS = {
         "event_joined": "You have successfully joined the event!",
         "event_full": "Sorry, this event is already full.",
         "event_left": "You have left the event.",
+        "event_not_found": "This event no longer exists.",
         "event_cancelled": "Event has been cancelled.",
         "no_events_available": "No events available at the moment.",
         "no_my_events": "You don't have any events yet.",
@@ -70,6 +71,7 @@ TEXTS = {
         "event_create_theme": "Enter event theme (e.g., Movie Quiz, Rock Karaoke):",
         "invalid_event_type": "Please select a valid event type",
         "invalid_difficulty": "Please select a valid difficulty level",
+        "invalid_number": "Please enter a number (or /skip)",
         "past_events": "📜 Past Events",
         "no_past_events": "No past events found",
         "past_events_list": "📜 Past Events:\n\n",
@@ -116,6 +118,7 @@ TEXTS = {
         "event_joined": "Вы успешно присоединились к событию!",
         "event_full": "Извините, это событие уже заполнено.",
         "event_left": "Вы покинули событие.",
+        "event_not_found": "Это событие больше не существует.",
         "event_cancelled": "Событие было отменено.",
         "no_events_available": "В данный момент нет доступных событий.",
         "no_my_events": "У вас пока нет событий.",
@@ -145,6 +148,7 @@ TEXTS = {
         "event_create_theme": "Введите тему мероприятия (например, Кино-квиз, Рок караоке):",
         "invalid_event_type": "Пожалуйста, выберите корректный тип мероприятия",
         "invalid_difficulty": "Пожалуйста, выберите корректный уровень сложности",
+        "invalid_number": "Пожалуйста, введите число (или /skip)",
         "past_events": "📜 Прошедшие события",
         "no_past_events": "Прошедших событий не найдено",
         "past_events_list": "📜 Прошедшие события:\n\n",
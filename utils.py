@@ -0,0 +1,35 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Iterable, List
+
+from aiogram.exceptions import TelegramRetryAfter
+
+# Telegram допускает около 30 сообщений в секунду на бота: оставляем запас
+TELEGRAM_MESSAGES_PER_SECOND = 25
+# Сколько раз пробуем отправить сообщение, если Telegram отвечает 429 Too Many Requests
+SEND_ATTEMPTS = 3
+
+async def send_with_retry(send: Callable[[], Awaitable[Any]], attempts: int = SEND_ATTEMPTS) -> Any:
+    """
+    Выполняет отправку. Если Telegram просит подождать, ждёт retry_after секунд и повторяет
+    """
+    for attempt in range(1, attempts + 1):
+        try:
+            return await send()
+        except TelegramRetryAfter as e:
+            if attempt == attempts:
+                raise
+            await asyncio.sleep(e.retry_after)
+
+async def gather_rate_limited(calls: Iterable[Callable[[], Awaitable[Any]]], per_second: int = TELEGRAM_MESSAGES_PER_SECOND) -> List[Any]:
+    """
+    Запускает вызовы конкурентно, но не более per_second новых вызовов в секунду.
+    Семафор ограничил бы только число запросов в полёте, а не их частоту.
+    Результаты возвращаются в порядке входных вызовов
+    """
+    tasks = []
+    for index, call in enumerate(calls):
+        # Секундное окно заполнено: следующая пачка стартует через секунду
+        if index and not index % per_second:
+            await asyncio.sleep(1)
+        tasks.append(asyncio.create_task(call()))
+    return await asyncio.gather(*tasks)